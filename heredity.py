@@ -1,5 +1,9 @@
+import collections
+import concurrent.futures
 import csv
 import itertools
+import math
+import os
 import sys
 
 PROBS = {
@@ -36,12 +40,53 @@ PROBS = {
     "mutation": 0.01
 }
 
+# PROBS as tuples indexed by gene count, and trait (False, True)
+GENE_P = tuple(PROBS["gene"][gene] for gene in range(3))
+TRAIT_P = tuple(
+    (PROBS["trait"][gene][False], PROBS["trait"][gene][True])
+    for gene in range(3)
+)
+
+# Probability that a parent with 0, 1 or 2 copies passes on the gene
+PASS_P = [
+    PROBS["mutation"],
+    0.5,
+    1 - PROBS["mutation"]
+]
+
+# Probability of a child having 0, 1 or 2 copies of the gene,
+# indexed by the number of copies their mother and father have
+CHILD_P = [
+    [
+        [
+            (1 - mother) * (1 - father),
+            mother * (1 - father) + (1 - mother) * father,
+            mother * father
+        ]
+        for father in PASS_P
+    ]
+    for mother in PASS_P
+]
+
+# Fewest gene and trait assignments worth enumerating across processes,
+# about a quarter second of serial work against ~20ms to start a pool
+PARALLEL_CONFIGURATIONS = 100000
+
+# Family data as parallel lists, one entry per person
+Pedigree = collections.namedtuple(
+    "Pedigree", ["names", "mother", "father", "trait"]
+)
+
 
 def main():
 
     # Check for proper usage
-    if len(sys.argv) != 2:
-        sys.exit("Usage: python heredity.py data.csv")
+    if len(sys.argv) == 2:
+        infer = eliminate
+    elif len(sys.argv) == 3 and sys.argv[2] == "--enumerate":
+        infer = enumerate_all
+    else:
+        sys.exit("Usage: python heredity.py data.csv [--enumerate]")
     people = load_data(sys.argv[1])
 
     # Keep track of gene and trait probabilities for each person
@@ -60,26 +105,8 @@ def main():
         for person in people
     }
 
-    # Loop over all sets of people who might have the trait
-    names = set(people)
-    for have_trait in powerset(names):
-
-        # Check if current set of people violates known information
-        fails_evidence = any(
-            (people[person]["trait"] is not None and
-             people[person]["trait"] != (person in have_trait))
-            for person in names
-        )
-        if fails_evidence:
-            continue
-
-        # Loop over all sets of people who might have the gene
-        for one_gene in powerset(names):
-            for two_genes in powerset(names - one_gene):
-
-                # Update probabilities with new joint probability
-                p = joint_probability(people, one_gene, two_genes, have_trait)
-                update(probabilities, one_gene, two_genes, have_trait, p)
+    # Add up the probability of every possible gene and trait
+    infer(people, probabilities)
 
     # Ensure probabilities sum to 1
     normalize(probabilities)
@@ -94,12 +121,191 @@ def main():
                 print(f"    {value}: {p:.4f}")
 
 
+def eliminate(people, probabilities):
+    """
+    Add to `probabilities` each person's unnormalized gene and trait
+    probabilities, computed by variable elimination over the family tree.
+
+    Each person contributes one factor over their own and their parents'
+    gene counts, with any known trait folded in as evidence. Summing out
+    everyone but one person at a time avoids enumerating every joint
+    assignment of genes and traits.
+    """
+    pedigree = index_people(people)
+    family = range(len(pedigree.names))
+
+    factors = []
+    for person in family:
+        mother = pedigree.mother[person]
+        father = pedigree.father[person]
+        parents = () if mother == -1 else (mother, father)
+        traits = (
+            [True, False] if pedigree.trait[person] is None
+            else [pedigree.trait[person]]
+        )
+        table = dict()
+        for genes in itertools.product(range(3), repeat=len(parents) + 1):
+            *parent_genes, gene = genes
+            parent_genes = parent_genes or [None, None]
+            table[genes] = sum(
+                person_probability(gene, *parent_genes, trait)
+                for trait in traits
+            )
+        factors.append((parents + (person,), table))
+
+    for person in family:
+
+        # Sum out everyone else, cheapest elimination first
+        remaining = factors
+        others = set(family) - {person}
+        while others:
+            other = min(others, key=lambda v: len(neighbours(v, remaining)))
+            others.remove(other)
+            involved = [f for f in remaining if other in f[0]]
+            remaining = [f for f in remaining if other not in f[0]]
+            remaining.append(sum_out(other, involved))
+
+        name = pedigree.names[person]
+        trait = pedigree.trait[person]
+        for gene in range(3):
+            p = product(remaining, {person: gene})
+            probabilities[name]["gene"][gene] += p
+            if trait is None:
+                for value in [True, False]:
+                    probabilities[name]["trait"][value] += (
+                        p * TRAIT_P[gene][value]
+                    )
+            else:
+                probabilities[name]["trait"][trait] += p
+
+
+def neighbours(variable, factors):
+    """
+    Return the set of variables sharing a factor with `variable`.
+    """
+    return {v for f in factors if variable in f[0] for v in f[0]}
+
+
+def product(factors, assignment):
+    """
+    Return the product of `factors` at the gene counts in `assignment`.
+    Each factor is a pair (variables, table), where `table` maps a tuple of
+    gene counts, one per variable, to a value.
+    """
+    probability = 1
+    for variables, table in factors:
+        probability *= table[tuple(assignment[v] for v in variables)]
+    return probability
+
+
+def sum_out(variable, factors):
+    """
+    Return a factor equal to the product of `factors` summed over `variable`.
+    """
+    variables = tuple(
+        dict.fromkeys(v for f in factors for v in f[0] if v != variable)
+    )
+
+    # Look up each factor by position in the combined gene counts
+    scope = variables + (variable,)
+    lookups = [
+        (table, [scope.index(v) for v in vs])
+        for vs, table in factors
+    ]
+
+    table = dict()
+    for genes in itertools.product(range(3), repeat=len(scope)):
+        probability = 1
+        for factor, positions in lookups:
+            probability *= factor[tuple([genes[i] for i in positions])]
+        table[genes[:-1]] = table.get(genes[:-1], 0) + probability
+    return variables, table
+
+
+def enumerate_all(people, probabilities):
+    """
+    Add to `probabilities` each person's unnormalized gene and trait
+    probabilities, computed by enumerating every joint assignment.
+
+    When there are enough assignments, the sets of people with one gene
+    are split across processes, and their results are added together.
+    """
+    one_genes = list(powerset((1 << len(people)) - 1))
+
+    # Every gene assignment is tried for every set of unknown traits
+    unknown = sum(people[person]["trait"] is None for person in people)
+    workers = 1
+    if 3 ** len(people) << unknown >= PARALLEL_CONFIGURATIONS:
+        workers = os.cpu_count() or 1
+    chunks = [one_genes[i::workers] for i in range(workers)]
+
+    if workers == 1:
+        results = [enumerate_chunk(people, one_genes)]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            results = list(executor.map(
+                enumerate_chunk, itertools.repeat(people), chunks
+            ))
+
+    for result in results:
+        for person in result:
+            for field in result[person]:
+                for value in result[person][field]:
+                    probabilities[person][field][value] += (
+                        result[person][field][value]
+                    )
+
+
+def enumerate_chunk(people, one_genes):
+    """
+    Return each person's unnormalized gene and trait probabilities,
+    summed over every joint assignment whose set of people with one gene
+    is in `one_genes`.
+    """
+    probabilities = {
+        person: {
+            "gene": {2: 0, 1: 0, 0: 0},
+            "trait": {True: 0, False: 0}
+        }
+        for person in people
+    }
+
+    # Encode sets of people as bitmasks, one bit per person
+    full_mask = (1 << len(people)) - 1
+    evidence_mask = 0
+    evidence_required = 0
+    for person in people:
+        bit = 1 << people[person]["index"]
+        if people[person]["trait"] is not None:
+            evidence_mask |= bit
+            if people[person]["trait"]:
+                evidence_required |= bit
+
+    kernel = specialize(index_people(people))
+
+    # Loop over all sets of people who might have the trait,
+    # only varying those whose trait is unknown
+    for unknown_trait in powerset(full_mask & ~evidence_mask):
+        have_trait = evidence_required | unknown_trait
+
+        # Loop over this chunk's sets of people who might have the gene
+        for one_gene in one_genes:
+            for two_genes in powerset(full_mask & ~one_gene):
+
+                # Update probabilities with new joint probability
+                p = kernel(one_gene, two_genes, have_trait)
+                update(probabilities, one_gene, two_genes, have_trait, p)
+
+    return probabilities
+
+
 def load_data(filename):
     """
     Load gene and trait data from a file into a dictionary.
     File assumed to be a CSV containing fields name, mother, father, trait.
     mother, father must both be blank, or both be valid names in the CSV.
     trait should be 0 or 1 if trait is known, blank otherwise.
+    Each person is also given an "index", their bit in a set bitmask.
     """
     data = dict()
     with open(filename) as f:
@@ -108,6 +314,7 @@ def load_data(filename):
             name = row["name"]
             data[name] = {
                 "name": name,
+                "index": data[name]["index"] if name in data else len(data),
                 "mother": row["mother"] or None,
                 "father": row["father"] or None,
                 "trait": (True if row["trait"] == "1" else
@@ -116,16 +323,32 @@ def load_data(filename):
     return data
 
 
-def powerset(s):
+def index_people(people):
     """
-    Return a list of all possible subsets of set s.
+    Return `people` as a Pedigree of lists indexed by each person's "index",
+    with parents given by index (-1 if unknown).
     """
-    s = list(s)
-    return [
-        set(s) for s in itertools.chain.from_iterable(
-            itertools.combinations(s, r) for r in range(len(s) + 1)
-        )
-    ]
+    def index_of(name):
+        return -1 if name is None else people[name]["index"]
+
+    return Pedigree(
+        names=list(people),
+        mother=[index_of(people[person]["mother"]) for person in people],
+        father=[index_of(people[person]["father"]) for person in people],
+        trait=[people[person]["trait"] for person in people]
+    )
+
+
+def powerset(mask):
+    """
+    Yield all possible subsets of the bitmask `mask`, as bitmasks.
+    """
+    subset = mask
+    while True:
+        yield subset
+        if subset == 0:
+            return
+        subset = (subset - 1) & mask
 
 
 def joint_probability(people, one_gene, two_genes, have_trait):
@@ -138,130 +361,86 @@ def joint_probability(people, one_gene, two_genes, have_trait):
         * everyone not in `one_gene` or `two_gene` does not have the gene, and
         * everyone in set `have_trait` has the trait, and
         * everyone not in set` have_trait` does not have the trait.
+
+    Sets are bitmasks, with bit `people[person]["index"]` for each person.
     """
-    set_people = set(people.keys())
-    set_no_genes = set_people - one_gene - two_genes
-    set_no_trait = set_people - have_trait
-    prob_two_genes_with_trait = 1
-    prob_two_genes_without_trait = 1
-    prob_one_gene_with_trait = 1
-    prob_one_gene_without_trait = 1
-    prob_no_genes_with_trait = 1
-    prob_no_genes_without_trait = 1
-
-    
-    for person in two_genes:
-        mother = people[person]['mother']
-        father = people[person]['father']
-        if mother == None and father == None:
-            probability = PROBS["gene"][2]
-        else:
-            if mother in two_genes and father in two_genes:
-                probability = 2*(1-PROBS["mutation"])
-            elif mother in set_no_genes and father in set_no_genes:
-                probability = PROBS["mutation"]**2
-            elif mother in one_gene and father in one_gene:
-                probability = 0.5*2*(1-PROBS["mutation"])
-            elif mother in one_gene and father in set_no_genes:
-                probability = 0.5*(1-PROBS["mutation"])*PROBS["mutation"]
-            elif father in one_gene and mother in set_no_genes:
-                probability = 0.5*(1-PROBS["mutation"])*PROBS["mutation"]
-            elif mother in two_genes and father in set_no_genes:
-                probability = (1-PROBS["mutation"])*PROBS["mutation"]
-            elif father in two_genes and mother in set_no_genes:
-                probability = (1-PROBS["mutation"])*PROBS["mutation"]
-            elif mother in one_gene and father in two_genes:
-                probability = 0.5*(1-PROBS["mutation"])**2
-            elif father in one_gene and mother in two_genes:
-                probability = 0.5*(1-PROBS["mutation"])**2
-            else:
-                raise TypeError
-
-                
-        if person in have_trait:
-            probability *= PROBS["trait"][2][True]
-            prob_two_genes_with_trait *= probability
-        elif person in set_no_trait:
-            probability *= PROBS["trait"][2][False]
-            prob_two_genes_without_trait *= probability
-        else:
-            print('Error')
-
-    
-    for person in one_gene:
-        mother = people[person]['mother']
-        father = people[person]['father']
-        if mother == None and father == None:
-            probability = PROBS["gene"][1]
-        else:
-            if mother in two_genes and father in two_genes:
-                probability = 1
-            elif mother in set_no_genes and father in set_no_genes:
-                probability = PROBS["mutation"]*(1-PROBS["mutation"])*2
-            elif mother in one_gene and father in set_no_genes:
-                probability = (0.5*(1-PROBS["mutation"])*(1-PROBS["mutation"])) + (0.5*(1-PROBS["mutation"])*PROBS["mutation"])
-            elif father in one_gene and mother in set_no_genes:
-                probability = (0.5*(1-PROBS["mutation"])*(1-PROBS["mutation"])) + (0.5*(1-PROBS["mutation"])*PROBS["mutation"])
-            elif mother in two_genes and father in set_no_genes:
-                probability = ((1-PROBS["mutation"])**2)+(PROBS["mutation"])**2
-            elif father in two_genes and mother in set_no_genes:
-                probability = ((1-PROBS["mutation"])**2)+(PROBS["mutation"])**2
-            elif mother in one_gene and father in one_gene:
-                probability = ((0.5*(1-PROBS["mutation"]))**2)*2
-            elif mother in one_gene and father in two_genes:
-                probability = ((1-PROBS["mutation"])**2)*0.5*2
-            elif mother in two_genes and father in one_gene:
-                probability = ((1-PROBS["mutation"])**2)*0.5*2
-            else:
-                raise TypeError
-            
-        if person in have_trait:
-            probability *= PROBS["trait"][1][True]
-            prob_one_gene_with_trait *= probability
-        elif person in set_no_trait:
-            probability *= PROBS["trait"][1][False]
-            prob_one_gene_without_trait *= probability
-        else:
-            print('Error')
-    
-    for person in set_no_genes:
-        mother = people[person]['mother']
-        father = people[person]['father']
-        if mother == None and father == None:
-            probability = PROBS["gene"][0]
-        else:
-            if mother in two_genes and father in two_genes:
-                probability = (PROBS["mutation"])**2
-            elif mother in set_no_genes and father in set_no_genes:
-                probability = (1-PROBS["mutation"])**2
-            elif mother in one_gene and father in set_no_genes:
-                probability = 0.5*(1-PROBS["mutation"])
-            elif father in one_gene and mother in set_no_genes:
-                probability = 0.5*(1-PROBS["mutation"])
-            elif mother in two_genes and father in set_no_genes:
-                probability = (PROBS["mutation"])*(1-PROBS["mutation"])
-            elif father in two_genes and mother in set_no_genes:
-                probability = (PROBS["mutation"])*(1-PROBS["mutation"])
-            elif mother in one_gene and father in one_gene:
-                probability = (0.5*(1-PROBS["mutation"]))**2
-            elif mother in one_gene and father in two_genes:
-                probability = (PROBS["mutation"])*0.5*(1-PROBS["mutation"])
-            elif mother in two_genes and father in one_gene:
-                probability = (PROBS["mutation"])*0.5*(1-PROBS["mutation"])
-            else:
-                raise TypeError
-
-        
-        if person in have_trait:
-            probability *= PROBS["trait"][0][True]
-            prob_no_genes_with_trait *= probability
-        elif person in set_no_trait:
-            probability *= PROBS["trait"][0][False]
-            prob_no_genes_without_trait *= probability
+    genes = dict()
+    for person in people:
+        bit = 1 << people[person]["index"]
+        genes[person] = 2 if bit & two_genes else 1 if bit & one_gene else 0
+
+    return math.prod(
+        person_probability(
+            genes[person],
+            genes.get(people[person]["mother"]),
+            genes.get(people[person]["father"]),
+            bool(have_trait >> people[person]["index"] & 1)
+        )
+        for person in people
+    )
+
+
+def specialize(pedigree):
+    """
+    Return a function of bitmasks `one_gene`, `two_genes` and `have_trait`
+    that computes `joint_probability` for the family in `pedigree`.
+
+    The function is generated as straight-line code, with everyone's bit
+    position and parents written in as constants and each person's
+    probability looked up in a single table.
+    """
+    lines = ["def kernel(one_gene, two_genes, have_trait):"]
+    for index in range(len(pedigree.names)):
+        lines.append(
+            f"    g{index} = 2 if two_genes >> {index} & 1 "
+            f"else one_gene >> {index} & 1"
+        )
+
+    factors = []
+    for index, parents in enumerate(zip(pedigree.mother, pedigree.father)):
+        mother, father = parents
+        trait = f"have_trait >> {index} & 1"
+        if mother == -1:
+            factors.append(f"founder[g{index}][{trait}]")
         else:
-            print('Error')
-    
-    return prob_no_genes_without_trait*prob_no_genes_with_trait*prob_one_gene_with_trait*prob_one_gene_without_trait*prob_two_genes_with_trait*prob_two_genes_without_trait
+            factors.append(f"child[g{mother}][g{father}][g{index}][{trait}]")
+    lines.append("    return " + (" * ".join(factors) or "1"))
+
+    # Probabilities by parents' and own gene count, then trait
+    namespace = {
+        "founder": [
+            [person_probability(gene, None, None, trait) for trait in [0, 1]]
+            for gene in range(3)
+        ],
+        "child": [
+            [
+                [
+                    [
+                        person_probability(gene, mother, father, trait)
+                        for trait in [0, 1]
+                    ]
+                    for gene in range(3)
+                ]
+                for father in range(3)
+            ]
+            for mother in range(3)
+        ]
+    }
+    exec("\n".join(lines), namespace)
+    return namespace["kernel"]
+
+
+def person_probability(gene, mother_gene, father_gene, trait):
+    """
+    Return the probability that one person has `gene` copies of the gene
+    and `trait`, given the number of copies their mother and father have
+    (both None if their parents are unknown).
+    """
+    if mother_gene is None and father_gene is None:
+        probability = GENE_P[gene]
+    else:
+        probability = CHILD_P[mother_gene][father_gene][gene]
+    return probability * TRAIT_P[gene][trait]
 
 
 def update(probabilities, one_gene, two_genes, have_trait, p):
@@ -270,34 +449,13 @@ def update(probabilities, one_gene, two_genes, have_trait, p):
     Each person should have their "gene" and "trait" distributions updated.
     Which value for each distribution is updated depends on whether
     the person is in `have_gene` and `have_trait`, respectively.
+    Bit `i` of each bitmask refers to the `i`th person in `probabilities`.
     """
-    for person in probabilities:
-        if person in one_gene:
-            if person in have_trait:
-                probabilities[person]["gene"][1] += p
-                probabilities[person]["trait"][True] += p
-            else:
-                probabilities[person]["gene"][1] += p
-                probabilities[person]["trait"][False] += p
-        elif person in two_genes:
-            if person in have_trait:
-                probabilities[person]["gene"][2] += p
-                probabilities[person]["trait"][True] += p
-            else:
-                probabilities[person]["trait"][False] += p
-                probabilities[person]["gene"][2] += p
-        elif person not in one_gene and person not in two_genes:
-            if person in have_trait:
-                probabilities[person]["gene"][0] += p
-                probabilities[person]["trait"][True] += p
-            else:
-                probabilities[person]["gene"][0] += p
-                probabilities[person]["trait"][False] += p
-        else:
-            if person in have_trait:
-                probabilities[person]["trait"][True] += p
-            else:
-                probabilities[person]["trait"][False] += p
+    for index, person in enumerate(probabilities):
+        bit = 1 << index
+        gene = 2 if bit & two_genes else 1 if bit & one_gene else 0
+        probabilities[person]["gene"][gene] += p
+        probabilities[person]["trait"][bool(bit & have_trait)] += p
 
 
 def normalize(probabilities):
@@ -306,10 +464,16 @@ def normalize(probabilities):
     is normalized (i.e., sums to 1, with relative proportions the same).
     """
     for person in probabilities:
-        for field in probabilities[person]:
-            total = sum(probabilities[person][field].values())
-            for value in probabilities[person][field]:
-                probabilities[person][field][value] = ((probabilities[person][field][value])*1)/total
+        gene = probabilities[person]["gene"]
+        total = gene[0] + gene[1] + gene[2]
+        gene[0] /= total
+        gene[1] /= total
+        gene[2] /= total
+
+        trait = probabilities[person]["trait"]
+        total = trait[True] + trait[False]
+        trait[True] /= total
+        trait[False] /= total
 
 
 if __name__ == "__main__":